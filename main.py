@@ -1,12 +1,20 @@
 from typing import Dict, List
-from datetime import datetime
-import pickle
+from array import array
+from itertools import islice
 import asyncio
+import msgspec
 
 import streamer
-from monitor import redis_conn
+from monitor import async_redis_conn, lob_depth, Snapshot
 from config import pairs
 
+# msgpack encoder for the dashboard payloads, reused across callbacks.
+_encoder = msgspec.msgpack.Encoder()
+
+# reusable buffer for the top levels, lob_depth rows of (bids_price,
+# bids_quantity, asks_price, asks_quantity) in native float64.
+_top = array('d', [0.0] * (lob_depth * 4))
+
 
 def run(pairs: List[str]) -> None:
     """Use redis stream to send over ts/spread/order book data.
@@ -19,10 +27,39 @@ def run(pairs: List[str]) -> None:
 
     stream = streamer.OrderBookStream()
 
-    def call_order_book(data: Dict):
+    # buffered redis writes, flushed by a single task at a time so batches
+    # reach redis in order and use one connection.
+    pipe = async_redis_conn.pipeline(transaction=False)
+    flush_task = None
+
+    async def flush_pipeline():
+        """Send the buffered hash sets to redis in a single round trip, writes
+        coming in while a batch is in flight go to a fresh pipeline which is
+        sent right after it.
+        """
+
+        nonlocal pipe, flush_task
+        try:
+            while len(pipe):
+                batch = pipe
+                pipe = async_redis_conn.pipeline(transaction=False)
+                await batch.execute()
+        finally:
+            flush_task = None
+
+    def on_flush_done(task: asyncio.Task):
+        """Report failed flushes, the failed batch is dropped and the next
+        write starts a new flush.
+        """
+
+        if not task.cancelled() and task.exception() is not None:
+            print(f'Warning: redis flush failed: {task.exception()!r}')
+
+    async def call_order_book(data: Dict):
         """Callback function that stores the spread and the order book of the
         given pair into redis via hash set, which can be retrieved in the
-        dash callback function for monitoring.
+        dash callback function for monitoring. Writes are pipelined so pairs
+        updated within the same event loop iteration share one round trip.
 
         Parameters
         ----------
@@ -30,41 +67,57 @@ def run(pairs: List[str]) -> None:
             Incoming stream changes to the orderbook/trade objects.
         """
 
-        ts = datetime.fromtimestamp(data['E'] / 1000)
-
-        if '_' in data['s']:
-            lob = stream.get_order_book_perp(data['s'])
-        else:
-            lob = stream.get_order_book(data['s'])
-
-        # TODO: redundant sanity check though, remove.
-        lob['asks'] = dict(sorted(lob['asks'].items()))
-        lob['bids'] = dict(sorted(lob['bids'].items(), reverse=True))
-
-        # generate spread
-        spread = round(float(list(lob['asks'].keys())[0]) - float(
-            list(lob['bids'].keys())[0]), 4)
-
-        # pass on the spread/order book data to the dashboard
-        dash_params = dict()
-        dash_params[f"{data['s']}_exchange_ts"] = ts
-        dash_params[f"{data['s']}_spread"] = spread
-        dash_params[f"{data['s']}_orderbook"] = lob
-        redis_conn.hset(data['s'], f"{data['s']}_spread",
-                        pickle.dumps(dash_params))
-
-    # For each pair, start streaming the order book object, close all streams
-    # upon keyboard interruption to stop the program.
-    for pair in pairs:
-        if '_' in pair:
-            stream.open_stream_order_book_perp(pair, call_order_book)
-        else:
-            stream.open_stream_order_book(pair, call_order_book)
+        nonlocal flush_task
+        lob = stream.get_order_book(data['s'])
+
+        # books are kept sorted from the best level, write the top levels
+        # into the reusable buffer instead of building new rows every update.
+        n = 0
+        for (bp, bq), (ap, aq) in zip(islice(lob['bids'].items(), lob_depth),
+                                      islice(lob['asks'].items(), lob_depth)):
+            _top[n] = bp / streamer.SCALE
+            _top[n + 1] = bq / streamer.SCALE
+            _top[n + 2] = ap / streamer.SCALE
+            _top[n + 3] = aq / streamer.SCALE
+            n += 4
+
+        # generate spread from the cached best levels, skip the update while
+        # one side of the book is empty.
+        if lob['_best_ask'] is None or lob['_best_bid'] is None:
+            return
+        spread = round(lob['_best_ask'] - lob['_best_bid'], 4)
+
+        # pass on the spread/top of the order book data to the dashboard, the
+        # buffer is copied as raw bytes by the encoder so it can be reused.
+        snap = Snapshot(exchange_ts=int(data['E']), spread=spread,
+                        top=memoryview(_top)[:n])
+        pipe.hset(data['s'], f"{data['s']}_spread", _encoder.encode(snap))
+
+        if flush_task is None:
+            flush_task = asyncio.ensure_future(flush_pipeline())
+            flush_task.add_done_callback(on_flush_done)
+
+    # Start streaming the order book objects, one combined stream for the spot
+    # pairs and one for the perpetuals, close all streams upon keyboard
+    # interruption to stop the program.
+    spot_pairs = [pair for pair in pairs if '_' not in pair]
+    perp_pairs = [pair for pair in pairs if '_' in pair]
+    if spot_pairs:
+        stream.open_stream_order_book(spot_pairs, call_order_book)
+    if perp_pairs:
+        stream.open_stream_order_book_perp(perp_pairs, call_order_book)
+    loop = asyncio.get_event_loop()
     try:
-        asyncio.get_event_loop().run_forever()
+        loop.run_forever()
     except KeyboardInterrupt:
-        stream.close()
-        asyncio.get_event_loop().stop()
+        # the loop has stopped, drive the shutdown, the last redis flush and
+        # close the redis connections.
+        loop.run_until_complete(stream.close())
+        if flush_task is not None:
+            loop.run_until_complete(
+                asyncio.gather(flush_task, return_exceptions=True))
+        loop.run_until_complete(
+            async_redis_conn.aclose(close_connection_pool=True))
 
 
 if __name__ == '__main__':
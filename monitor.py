@@ -1,13 +1,14 @@
 from collections import deque
-import pickle
+from datetime import datetime
 import dash
-from plotly.graph_objs import Table, Scatter
+from plotly.graph_objs import Figure, Table, Scatter
 from plotly.subplots import make_subplots
-import dash_core_components as dcc
-import dash_html_components as html
-from dash.dependencies import Input, Output
+from dash import dcc, html, Patch, no_update
+from dash.dependencies import Input, Output, State
 import redis
-import pandas as pd
+import redis.asyncio
+import msgspec
+import numpy as np
 
 from config import pairs
 
@@ -15,8 +16,35 @@ from config import pairs
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
 
-# set up redis, default port/localhost
+# set up redis, default port/localhost. The dash callbacks run in threads
+# and use the sync client, the order book stream shares the asyncio loop.
 redis_conn = redis.StrictRedis()
+async_redis_conn = redis.asyncio.Redis(
+    connection_pool=redis.asyncio.ConnectionPool(max_connections=16))
+
+
+class Snapshot(msgspec.Struct):
+    """Payload published to redis by the order book stream for each pair.
+
+    Attributes
+    ----------
+    exchange_ts: int
+        Exchange event time in epoch milliseconds.
+    spread: float
+        Spread between the best ask and the best bid.
+    top: memoryview
+        Top lob_depth levels as raw float64 rows of (bids_price,
+        bids_quantity, asks_price, asks_quantity). The producer passes a view
+        of its reusable buffer, the decoder returns a view of the payload.
+    """
+
+    exchange_ts: int
+    spread: float
+    top: memoryview
+
+
+# msgpack decoder for the payloads published by the order book stream.
+_decoder = msgspec.msgpack.Decoder(Snapshot)
 
 # params for the dashboard
 interval = 1
@@ -40,128 +68,181 @@ def add_dash():
         None
     """
 
-    components = [
-        html.Div(id='spreads_plotly'),
-        dcc.Interval(
-            id='tables-update',
-            interval=interval * 1000,
-            n_intervals=0
-        )
-    ]
-    app.layout = html.Div(children=components)
     timestamps_queue = {pair: deque(maxlen=graph_len) for pair in pairs}
     spreads_queue = {pair: deque(maxlen=graph_len) for pair in pairs}
-
-    def init_callback(app):
-        """Dash callback functions matched based on ids to update Dash objects
-        from data added to Redis.
+    # exchange_ts in epoch ms of the newest point held in the deques.
+    last_ts = {pair: None for pair in pairs}
+
+    # the subplot grids are data independent, build them once and only swap
+    # the traces when a page is loaded.
+    fig_quotes_template = make_subplots(
+        rows=1,
+        cols=len(pairs),
+        subplot_titles=pairs,
+        specs=table_specs
+    )
+    fig_quotes_template.update_layout(
+        width=1900,
+        height=300,
+        showlegend=False,
+        autosize=True,
+        font=dict(size=8),
+        margin=dict(b=0, t=20),
+    )
+
+    fig_hist_spreads_template = make_subplots(
+        rows=1,
+        cols=len(pairs),
+        specs=graph_specs,
+    )
+    fig_hist_spreads_template.update_layout(
+        width=1900,
+        height=300,
+        showlegend=False,
+        autosize=True,
+        font=dict(size=8),
+        margin=dict(b=0, t=0),
+    )
+
+    # resolve the domain/axes of each pair's subplot from the grids.
+    table_domains = [fig_quotes_template.get_subplot(1, idx + 1)
+                     for idx in range(len(pairs))]
+    scatter_axes = [fig_hist_spreads_template.get_subplot(1, idx + 1)
+                    for idx in range(len(pairs))]
+
+    def make_figures():
+        """Build the full figures for a page load, the historical spreads
+        start from what has been collected so far and both figures are then
+        only patched by the callback.
         """
 
-        @app.callback(
-            Output('spreads_plotly', 'children'),
-            [Input('tables-update', 'n_intervals')]
-        )
-        def update_quotes_balances_plotly(n):
-            """Get the dict objects from Redis memory and update Plotly Table,
-            where each table has a unique id based on its pair. The callback
-            collects spreads/order book data from Redis memory, so any update
-            will be updated per interval specified in config.
-            """
+        quotes, hist_spreads = list(), list()
+        for idx, pair in enumerate(pairs):
+            quotes.append(
+                Table(
+                    header=dict(
+                        values=[f'bids_price', f'bids_quantity',
+                                f'asks_price', f'asks_quantity'],
+                        line_color='darkslategray',
+                        fill_color='royalblue',
+                        align='center',
+                        font=dict(color='white', size=8),
+                    ),
+                    cells=dict(
+                        values=[[], [], [], []],
+                        line_color='darkslategray',
+                        fill_color='white',
+                        align='center',
+                    ),
+                    domain=dict(x=table_domains[idx].x,
+                                y=table_domains[idx].y),
+                )
+            )
 
-            fig_quotes = make_subplots(
-                rows=1,
-                cols=len(pairs),
-                subplot_titles=pairs,
-                specs=table_specs
+            hist_spreads.append(
+                Scatter(
+                    x=list(timestamps_queue[pair]),
+                    y=list(spreads_queue[pair]),
+                    name='Historical Spreads',
+                    mode='lines+markers',
+                    marker=dict(color='royalblue'),
+                    xaxis=scatter_axes[idx].yaxis.anchor,
+                    yaxis=scatter_axes[idx].xaxis.anchor,
+                )
             )
 
-            fig_hist_spreads = make_subplots(
-                rows=1,
-                cols=len(pairs),
-                specs=graph_specs,
+        fig_quotes = Figure(data=quotes, layout=fig_quotes_template.layout)
+        fig_hist_spreads = Figure(data=hist_spreads,
+                                  layout=fig_hist_spreads_template.layout)
+        return fig_quotes, fig_hist_spreads
+
+    def serve_layout():
+        """Dash layout served on each page load with freshly built figures.
+        """
+
+        fig_quotes, fig_hist_spreads = make_figures()
+        components = [
+            # newest exchange_ts sent to this page per pair, so unchanged
+            # snapshots are not appended to its history again.
+            dcc.Store(id='last-sent', data=dict(last_ts)),
+            html.Div([
+                dcc.Graph(id='quotes', figure=fig_quotes)
+            ]),
+            html.Div([
+                dcc.Graph(id='graphs', figure=fig_hist_spreads)
+            ]),
+            dcc.Interval(
+                id='tables-update',
+                interval=interval * 1000,
+                n_intervals=0
             )
+        ]
+        return html.Div(children=components)
 
-            for idx, pair in enumerate(pairs):
-                params = pickle.loads(redis_conn.hget(pair, f'{pair}_spread'))
-
-                # convert dict objects into arrays for plotly tables.
-                exchange_ts = params[f'{pair}_exchange_ts']
-                spreads = params[f'{pair}_spread']
-                lob = params[f'{pair}_orderbook']
-                lob_d = dict(bids_price=list(), bids_quantity=list(),
-                             asks_price=list(), asks_quantity=list())
-
-                # limit depth number for displaying order book.
-                for i, (bids, asks) in enumerate(
-                        zip(lob['bids'].items(), lob['asks'].items())):
-                    lob_d['bids_price'].append(round(float(bids[0]), 4))
-                    lob_d['bids_quantity'].append(round(float(bids[1]), 4))
-                    lob_d['asks_price'].append(round(float(asks[0]), 4))
-                    lob_d['asks_quantity'].append(round(float(asks[1]), 4))
-                    if i >= lob_depth - 1:
-                        break
-
-                lob_d = pd.DataFrame(lob_d)
-                timestamps_queue[pair].append(exchange_ts)
-                spreads_queue[pair].append(spreads)
-
-                fig_quotes.add_trace(
-                    Table(
-                        header=dict(
-                            values=[f'bids_price', f'bids_quantity',
-                                    f'asks_price', f'asks_quantity'],
-                            line_color='darkslategray',
-                            fill_color='royalblue',
-                            align='center',
-                            font=dict(color='white', size=8),
-                        ),
-                        cells=dict(
-                            values=list(lob_d.T.values),
-                            line_color='darkslategray',
-                            fill_color='white',
-                            align='center',
-                        )
-                    ),
-                    row=1, col=idx + 1
-                )
+    app.layout = serve_layout
 
-                fig_hist_spreads.add_trace(
-                    Scatter(
-                        x=list(timestamps_queue[pair]),
-                        y=list(spreads_queue[pair]),
-                        name='Historical Spreads',
-                        mode='lines+markers',
-                        marker=dict(color='royalblue')
-                    ),
-                    row=1, col=idx + 1
-                )
+    def init_callback(app):
+        """Dash callback functions matched based on ids to update Dash objects
+        from data added to Redis.
+        """
 
-                fig_quotes.update_layout(
-                    width=1900,
-                    height=300,
-                    showlegend=False,
-                    autosize=True,
-                    font=dict(size=8),
-                    margin=dict(b=0, t=20),
-                )
+        @app.callback(
+            [Output('quotes', 'figure'), Output('graphs', 'extendData'),
+             Output('last-sent', 'data')],
+            [Input('tables-update', 'n_intervals')],
+            [State('last-sent', 'data')]
+        )
+        def update_quotes_balances_plotly(n, last_sent):
+            """Get the snapshots from Redis memory, patch the Plotly Tables and
+            extend the historical spreads, where each pair has its own trace
+            index. The callback collects spreads/order book data from Redis
+            memory, so any update will be updated per interval specified in
+            config. Only the table cells and the new spread points are sent to
+            the browser, each page trims its own history to graph_len points.
+            """
 
-                fig_hist_spreads.update_layout(
-                    width=1900,
-                    height=300,
-                    showlegend=False,
-                    autosize=True,
-                    font=dict(size=8),
-                    margin=dict(b=0, t=0),
-                )
-            dts = [
-                html.Div([
-                    dcc.Graph(id='quotes', figure=fig_quotes)
-                ]),
-                html.Div([
-                    dcc.Graph(id='graphs', figure=fig_hist_spreads)
-                ])
-            ]
-            return dts
+            patch_quotes = Patch()
+            hist_x, hist_y, hist_idx = list(), list(), list()
+
+            # fetch the payloads of all pairs in a single round trip.
+            pipe = redis_conn.pipeline(transaction=False)
+            for pair in pairs:
+                pipe.hget(pair, f'{pair}_spread')
+            payloads = pipe.execute()
+
+            for idx, (pair, raw) in enumerate(zip(pairs, payloads)):
+                snap = _decoder.decode(raw)
+
+                # convert the snapshot into arrays for plotly tables.
+                exchange_ts = datetime.fromtimestamp(snap.exchange_ts / 1000)
+                spreads = snap.spread
+                lob = snap.top
+
+                # order book arrives already limited to lob_depth levels as
+                # raw float64 rows, transposed into the four column lists.
+                lob_d = np.frombuffer(lob, dtype=np.float64).reshape(-1, 4)
+                lob_d = lob_d.round(4).T.tolist()
+                patch_quotes['data'][idx]['cells']['values'] = lob_d
+
+                # the shared history only seeds the figures of new pages, skip
+                # snapshots already recorded when several pages are polling.
+                if last_ts[pair] != snap.exchange_ts:
+                    last_ts[pair] = snap.exchange_ts
+                    timestamps_queue[pair].append(exchange_ts)
+                    spreads_queue[pair].append(spreads)
+
+                # likewise only extend this page's trace with new snapshots.
+                if last_sent.get(pair) != snap.exchange_ts:
+                    last_sent[pair] = snap.exchange_ts
+                    hist_x.append([exchange_ts])
+                    hist_y.append([spreads])
+                    hist_idx.append(idx)
+
+            if not hist_idx:
+                return patch_quotes, no_update, no_update
+            extend_hist_spreads = (dict(x=hist_x, y=hist_y), hist_idx,
+                                   graph_len)
+            return patch_quotes, extend_hist_spreads, last_sent
 
     init_callback(app=app)
     return app
@@ -169,4 +250,4 @@ def add_dash():
 
 if __name__ == '__main__':
     app = add_dash()
-    app.run_server(debug=False, dev_tools_ui=False, dev_tools_props_check=False)
+    app.run(debug=False, dev_tools_ui=False, dev_tools_props_check=False)
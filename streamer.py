@@ -1,22 +1,65 @@
-from typing import Callable, Dict
-import json
-from decimal import Decimal
+from typing import Callable, Dict, List, Optional
 from collections import namedtuple
-import urllib.request
-import urllib.parse
 import asyncio
+import aiohttp
 import websockets
+import msgspec
+from sortedcontainers import SortedDict
 
 
 # Define urls needed for order book streams
 URL_ORDER_BOOK = "https://api.binance.com/api/v1/depth"
 URL_ORDER_BOOK_PERP = "https://dapi.binance.com/dapi/v1/depth"
 
+# Delays in seconds before fetching the snapshot of a failed pair again,
+# doubled on each consecutive failure to stay clear of Binance's rate limits.
+SNAPSHOT_RETRY_DELAY = 1
+SNAPSHOT_RETRY_MAX_DELAY = 60
+
 # OrderBook object
-OrderBook = namedtuple("OrderBook", "bids asks")
+OrderBook = namedtuple("OrderBook", "bids asks last_update_id")
+
+# JSON decoder shared by the REST snapshots and the websocket updates.
+_json_decoder = msgspec.json.Decoder()
+
+# HTTP session for the REST snapshots, created lazily on the running loop.
+_session: Optional[aiohttp.ClientSession] = None
+
+# Fixed-point scale for prices/quantities, Binance quotes up to 8 decimals.
+SCALE = 10 ** 8
+
+
+def to_fixed_point(s: str) -> int:
+    """Parse a decimal string from Binance into a fixed-point integer scaled
+    by SCALE, which is much cheaper than building a Decimal.
+
+    Parameters
+    ----------
+    s: str
+        Decimal string, e.g: '9243.51000000'.
+
+    Returns
+    -------
+    value: int
+    """
+
+    whole, _, frac = s.partition('.')
+    return int(whole) * SCALE + int((frac + '00000000')[:8])
+
+
+def _get_session() -> aiohttp.ClientSession:
+    """Shared HTTP session so the snapshots of all pairs reuse the same
+    connection pool.
+    """
+
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession()
+    return _session
 
 
-def on_order_book(symbol: str, limit: int = 1000) -> OrderBook:
+async def on_order_book(symbol: str, limit: int = 1000,
+                        perp: Optional[bool] = None) -> OrderBook:
     """Get the full order book of a pair on Binance through public endpoint.
 
     Parameters
@@ -25,31 +68,32 @@ def on_order_book(symbol: str, limit: int = 1000) -> OrderBook:
         Pair without underscore in between base/quote coin, e.g: BTCETH, ETHBRL.
     limit: int
         Maximum depth for the order book, which should be 1000 by default.
+    perp: Optional[bool]
+        Whether the pair is a perpetual, inferred from the symbol if not given.
 
     Returns
     -------
     order_book: OrderBook
+        Bids/asks as (price, quantity) pairs in fixed-point, see SCALE, and the
+        id of the last update included in the snapshot.
     """
 
     bids, asks = list(), list()
     attributes = {"symbol": symbol, "limit": limit}
-    if '_' in symbol:
-        url = f'{URL_ORDER_BOOK_PERP}?{urllib.parse.urlencode(attributes)}'
-    else:
-        url = f'{URL_ORDER_BOOK}?{urllib.parse.urlencode(attributes)}'
-
-    try:
-        req = urllib.request.Request(url, method='GET')
-        resp = urllib.request.urlopen(req)
-        res = json.loads(resp.read())
-    except urllib.error.HTTPError as e:
-        raise Exception(f'{e.read()}')
+    if perp is None:
+        perp = '_' in symbol
+    url = URL_ORDER_BOOK_PERP if perp else URL_ORDER_BOOK
+
+    async with _get_session().get(url, params=attributes) as resp:
+        if resp.status != 200:
+            raise Exception(f'{await resp.read()}')
+        res = _json_decoder.decode(await resp.read())
 
     for bid in res['bids']:
-        bids.append((Decimal(bid[0]), Decimal(bid[1])))
+        bids.append((to_fixed_point(bid[0]), to_fixed_point(bid[1])))
     for ask in res['asks']:
-        asks.append((Decimal(ask[0]), Decimal(ask[1])))
-    order_book = OrderBook(bids, asks)
+        asks.append((to_fixed_point(ask[0]), to_fixed_point(ask[1])))
+    order_book = OrderBook(bids, asks, res['lastUpdateId'])
     return order_book
 
 
@@ -60,21 +104,26 @@ class OrderBookStream:
         streaming object with the symbol as key.
         """
 
-        self._order_books = dict()
-        self._order_books_perp = dict()
-        self._sockets = set()
-        self._tasks = dict()
+        self._books = dict()
+        self._is_perp = dict()
+        self._sockets = dict()
+        self._tasks = list()
+        self._ready = set()
+        self._pending = dict()
+        self._snapshot_tasks = dict()
+        self._retry_at = dict()
+        self._retry_delay = dict()
 
     def get_order_book(self, symbol: str) -> Dict:
-        return self._order_books[symbol]
-
-    def get_order_book_perp(self, symbol: str) -> Dict:
-        return self._order_books_perp[symbol]
+        return self._books[symbol]
 
     def update_order_book(self, symbol: str, updates: Dict):
         """With incoming stream updates for the order book, update this object
         by each depth. Overwrites existing depth level price with update's
-        quantity or remove the depth level with no remaining quantity.
+        quantity or remove the depth level with no remaining quantity. Prices
+        and quantities are stored in fixed-point, see SCALE. The best ask/bid
+        prices are cached in fixed-point and as floats, and only refreshed when
+        an update touches a level at or through the current best.
 
         Parameters
         ----------
@@ -85,40 +134,132 @@ class OrderBookStream:
             Dict containing order book updates.
         """
 
-        # TODO: easiest way to differentiate spots from perpetuals
-        if '_' in symbol:
-            book = self._order_books_perp[symbol]
-        else:
-            book = self._order_books[symbol]
-
-        # initialize the order book.
-        if len(book['asks']) == 0 and len(book['bids']) == 0:
-            order_book = on_order_book(symbol)
-            for (p, q) in order_book.asks:
-                book['asks'][p] = q
-            for (p, q) in order_book.bids:
-                book['bids'][p] = q
+        book = self._books[symbol]
 
-        # update order book with incoming updates across each depth.
+        # update order book with incoming updates across each depth, the
+        # cached best levels are compared in fixed-point and only looked up
+        # again when an update lands at or through them.
         asks, bids = updates['a'], updates['b']
+        best_ask = book['_best_ask_fp']
+        ask_touched = best_ask is None
         for ask in asks:
-            p, q = Decimal(ask[0]), Decimal(ask[1])
+            p, q = to_fixed_point(ask[0]), to_fixed_point(ask[1])
             if q > 0:
                 book['asks'][p] = q
             elif p in book['asks']:
                 del book['asks'][p]
+            ask_touched = ask_touched or p <= best_ask
 
+        best_bid = book['_best_bid_fp']
+        bid_touched = best_bid is None
         for bid in bids:
-            p, q = Decimal(bid[0]), Decimal(bid[1])
+            p, q = to_fixed_point(bid[0]), to_fixed_point(bid[1])
             if q > 0:
                 book['bids'][p] = q
             elif p in book['bids']:
                 del book['bids'][p]
+            bid_touched = bid_touched or p >= best_bid
+
+        if ask_touched:
+            best_ask = book['asks'].keys()[0] if book['asks'] else None
+            book['_best_ask_fp'] = best_ask
+            book['_best_ask'] = None if best_ask is None else best_ask / SCALE
+        if bid_touched:
+            best_bid = book['bids'].keys()[0] if book['bids'] else None
+            book['_best_bid_fp'] = best_bid
+            book['_best_bid'] = None if best_bid is None else best_bid / SCALE
+
+    def _add_order_book(self, symbol: str, perp: bool):
+        """Register an empty order book for the given pair, which is filled
+        from its snapshot.
+        """
+
+        self._books[symbol] = {'bids': SortedDict(lambda k: -k),
+                               'asks': SortedDict(),
+                               '_best_bid': None, '_best_ask': None,
+                               '_best_bid_fp': None, '_best_ask_fp': None}
+        self._is_perp[symbol] = perp
+
+    def _start_snapshot(self, symbol: str):
+        """Fetch the snapshot of the given pair in the background, updates
+        received meanwhile are buffered instead of blocking the stream.
+        """
+
+        self._pending[symbol] = list()
+        self._snapshot_tasks[symbol] = asyncio.ensure_future(
+            self._load_order_book(symbol))
+
+    async def _load_order_book(self, symbol: str):
+        """Initialize the order book of the given pair from its snapshot and
+        replay the buffered updates that are newer than the snapshot, as
+        described in Binance's guide to manage a local order book.
+        """
+
+        try:
+            order_book = await on_order_book(symbol,
+                                             perp=self._is_perp[symbol])
+            self._add_order_book(symbol, perp=self._is_perp[symbol])
+            book = self._books[symbol]
+            for (p, q) in order_book.asks:
+                book['asks'][p] = q
+            for (p, q) in order_book.bids:
+                book['bids'][p] = q
+            for updates in self._pending[symbol]:
+                if updates['u'] > order_book.last_update_id:
+                    self.update_order_book(symbol=symbol, updates=updates)
+        except Exception as e:
+            print(f'Warning: snapshot failed for {symbol}: {e!r}')
+            self._back_off(symbol)
+            return
+        finally:
+            del self._pending[symbol]
+            del self._snapshot_tasks[symbol]
+        self._ready.add(symbol)
+
+    def _back_off(self, symbol: str):
+        """Mark the order book of the given pair as out of sync, its updates
+        are dropped until the retry delay expires and a new snapshot is
+        fetched. The delay doubles on consecutive failures and starts over
+        once the pair has been healthy for longer than the maximum delay.
+        """
 
-    def open_stream_order_book(self, symbol: str, callback: Callable):
-        """Open order book stream for the given pair, provides callback function
-        for the asynchronous task for streaming order book object which is used
-        to process the updated depth levels of the order book.
+        now = asyncio.get_event_loop().time()
+        delay = self._retry_delay.get(symbol, 0)
+        if now - self._retry_at.get(symbol, now) > SNAPSHOT_RETRY_MAX_DELAY:
+            delay = 0
+        delay = min(max(2 * delay, SNAPSHOT_RETRY_DELAY),
+                    SNAPSHOT_RETRY_MAX_DELAY)
+        self._retry_delay[symbol] = delay
+        self._retry_at[symbol] = now + delay
+        self._ready.discard(symbol)
+
+    def _apply_update(self, symbol: str, updates: Dict) -> bool:
+        """Apply the stream update to the order book of the given pair if it
+        is in sync, otherwise buffer it while its snapshot is loading or drop
+        it while backing off.
+
+        Returns
+        -------
+        applied: bool
+            Whether the order book was updated.
+        """
+
+        if symbol in self._ready:
+            self.update_order_book(symbol=symbol, updates=updates)
+            return True
+        if symbol not in self._pending:
+            now = asyncio.get_event_loop().time()
+            if now < self._retry_at.get(symbol, now):
+                return False
+            self._start_snapshot(symbol)
+        self._pending[symbol].append(updates)
+        return False
+
+    def open_stream_order_book(self, symbols: List[str], callback: Callable):
+        """Open a combined order book stream for the given pairs, provides
+        callback function for the asynchronous task for streaming order book
+        object which is used to process the updated depth levels of the order
+        book. All pairs share a single websocket connection.
 
         From Binance's API doc:
             The data in each event is the absolute quantity for a price level.
@@ -128,23 +269,28 @@ class OrderBookStream:
 
         Parameters
         ----------
-        symbol: str
-            Pair without underscore in between base/quote coin, e.g: BTCETH,
+        symbols: List[str]
+            Pairs without underscore in between base/quote coin, e.g: BTCETH,
             ETHBRL.
         callback: Callable
-            Callback to handle the processing of the stream data.
+            Coroutine callback to handle the processing of the stream data.
         """
 
-        self._order_books[symbol] = {'bids': {}, 'asks': {}}
-        url = f'wss://stream.binance.com:9443/ws/{symbol.lower()}@depth'
-        asyncio.Task(
-            self.run(url=url, id=f'depth_{symbol.lower()}', callback=callback))
-
-    def open_stream_order_book_perp(self, symbol: str, callback: Callable):
-        """For perpetual only, open order book stream for the given pair,
-        provides callback function for the asynchronous task for streaming order
-        book object which is used to process the updated depth levels of the
-        order book.
+        for symbol in symbols:
+            self._add_order_book(symbol, perp=False)
+            self._start_snapshot(symbol)
+        streams = '/'.join(f'{symbol.lower()}@depth' for symbol in symbols)
+        url = f'wss://stream.binance.com:9443/stream?streams={streams}'
+        self._tasks.append(asyncio.ensure_future(
+            self.run(url=url, id='depth', callback=callback)))
+
+    def open_stream_order_book_perp(self, symbols: List[str],
+                                    callback: Callable):
+        """For perpetual only, open a combined order book stream for the given
+        pairs, provides callback function for the asynchronous task for
+        streaming order book object which is used to process the updated depth
+        levels of the order book. All pairs share a single websocket
+        connection.
 
         From Binance's API doc:
             The data in each event is the absolute quantity for a price level.
@@ -154,17 +300,19 @@ class OrderBookStream:
 
         Parameters
         ----------
-        symbol: str
-            Pair without underscore in between base/quote coin, e.g: BTCETH,
-            ETHBRL.
+        symbols: List[str]
+            Pairs with underscore for the contract type, e.g: BTCUSD_PERP.
         callback: Callable
-            Callback to handle the processing of the stream data.
+            Coroutine callback to handle the processing of the stream data.
         """
 
-        self._order_books_perp[symbol] = {'bids': {}, 'asks': {}}
-        url = f'wss://dstream.binance.com/stream?streams={symbol.lower()}@depth'
-        asyncio.Task(self.run(url=url, id=f'depth_perp_{symbol.lower()}',
-                     callback=callback))
+        for symbol in symbols:
+            self._add_order_book(symbol, perp=True)
+            self._start_snapshot(symbol)
+        streams = '/'.join(f'{symbol.lower()}@depth' for symbol in symbols)
+        url = f'wss://dstream.binance.com/stream?streams={streams}'
+        self._tasks.append(asyncio.ensure_future(
+            self.run(url=url, id='depth_perp', callback=callback)))
 
     async def run(self, url: str, id: str, callback: Callable):
         """Responsible for opening a stream for a given object, such as order
@@ -178,9 +326,10 @@ class OrderBookStream:
         url: str
             URL.
         id: str
-            Identifier for the object, which should refer to v1 url.
+            Identifier for the stream, 'depth' or 'depth_perp' for the combined
+            order book streams of the spot/perpetual pairs.
         callback: Callable
-            Callback to handle the processing of the stream data.
+            Coroutine callback to handle the processing of the stream data.
         """
 
         # keeping track of streams to avoid duplicates.
@@ -189,32 +338,60 @@ class OrderBookStream:
             return
         print(f'Starting stream: {url}')
 
-        # keep track of opened sockets and async tasks.
+        # keep track of opened sockets, closing one ends its pending recv.
         # process the updates based on stream object's ID.
         async with websockets.connect(url) as socket:
-            self._sockets.add(id)
+            self._sockets[id] = socket
             while id in self._sockets:
-                recv_task = asyncio.Task(socket.recv())
-                self._tasks[id] = recv_task
-                data = await recv_task
-                data = json.loads(data)
-                del self._tasks[id]
-                if id.find('depth') == 0:
-                    if id.find('depth_perp') == 0:
+                try:
+                    data = await socket.recv()
+                except websockets.ConnectionClosed:
+                    if id not in self._sockets:
+                        break
+                    raise
+
+                # all pairs share this loop, a pair whose update fails backs
+                # off and is rebuilt from a new snapshot, a failing callback
+                # is only reported as the book itself is still in sync.
+                symbol = None
+                try:
+                    data = _json_decoder.decode(data)
+                    if id.find('depth') == 0:
+                        # combined streams wrap the payload of each pair.
                         data = data['data']
-                    symbol = data['s']
-                    self.update_order_book(symbol=symbol, updates=data)
-                callback(data)
-                await(asyncio.sleep(.1))
-
-    def close(self):
+                        symbol = data['s']
+                        if not self._apply_update(symbol, data):
+                            continue
+                except Exception as e:
+                    print(f'Warning: stream {id} failed to update {symbol}: '
+                          f'{e!r}')
+                    if symbol in self._books:
+                        self._back_off(symbol)
+                    continue
+
+                try:
+                    await callback(data)
+                except Exception as e:
+                    print(f'Warning: stream {id} callback failed on {symbol}: '
+                          f'{e!r}')
+
+    async def close(self):
         """Close all streams upon keyboard interruption for all async tasks used
         for streaming, also doable by setting a timer for the duration of the
-        streams.
+        streams. Closing the sockets ends their pending recv, stream tasks
+        still connecting are cancelled, and the HTTP session is closed.
         """
 
         print('closing all streams')
-        for key in self._tasks:
-            self._tasks[key].cancel()
+        sockets = list(self._sockets.values())
         self._sockets.clear()
+        await asyncio.gather(*(socket.close() for socket in sockets),
+                             return_exceptions=True)
+        tasks = self._tasks + list(self._snapshot_tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
+        if _session is not None:
+            await _session.close()
         print('closed all streams')